@@ -3,9 +3,9 @@ Analyze Service - Analyzes monitoring data and decides adaptation.
 """
 import paho.mqtt.client as mqtt
 import json
-import time
 import uuid
 import os
+import socket
 
 # Load config
 with open('/app/config.json') as f:
@@ -14,90 +14,102 @@ with open('/app/config.json') as f:
 BROKER = os.environ.get('MQTT_BROKER', CONFIG['mqtt']['broker'])
 PORT = CONFIG['mqtt']['port']
 TOPICS = CONFIG['topics']
+MONITOR_RESULT = TOPICS['monitor_result']
+ANALYZE_RESULT = TOPICS['analyze_result']
+
+encode = json.JSONEncoder(separators=(',', ':')).encode
+
+# Prebuilt no-adaptation payload; Plan only needs the flag to continue
+CONTINUE = encode({
+    'requires_adaptation': False,
+    'adaptation_type': None,
+    'reason': None
+}).encode('utf-8')
 
 client = None
 
+# Last monitor payload and the decision it produced
+last_monitor_payload = None
+last_decision = CONTINUE
+last_label = 'continue'
+
+# Adaptation rules, checked in order: (check, adaptation_type, reason, log label)
+RULES = (
+    # Rule 1: Mission complete
+    (lambda p, mission, loaded: mission and not loaded and p.get('at_base', False),
+     'end_mission', 'Back at base', 'end_mission'),
+    # Rule 2: At delivery location
+    (lambda p, mission, loaded: p.get('at_delivery_location') and loaded,
+     'deliver', 'At delivery location', 'deliver'),
+    # Rule 3: Start mission
+    (lambda p, mission, loaded: p.get('needs_new_mission') and not mission,
+     'start_mission', 'Capacity or timeout', 'start_mission'),
+    # Rule 4: Path blocked
+    (lambda p, mission, loaded: p.get('path_blocked') and mission,
+     'replan', 'Path blocked', 'replan (blocked)'),
+    # Rule 5: Obstacle removed
+    (lambda p, mission, loaded: p.get('obstacle_removed') and mission,
+     'replan', 'Obstacle removed', 'replan (obstacle removed)'),
+)
+
 
 def handle_message(client_obj, userdata, msg):
-    global client
+    global client, last_monitor_payload, last_decision, last_label
     
     try:
         topic = msg.topic
-        payload = json.loads(msg.payload.decode('utf-8')) if msg.payload else {}
         
-        if topic == TOPICS['monitor_result']:
+        # An unchanged monitor result yields the same decision; skip parsing it
+        if topic == MONITOR_RESULT and msg.payload == last_monitor_payload:
+            client.publish(ANALYZE_RESULT, last_decision)
+            print(f"[Analyze] Decision: {last_label}")
+            return
+        
+        payload = json.loads(msg.payload) if msg.payload else {}
+        
+        if topic == MONITOR_RESULT:
+            publish = client.publish
+            last_monitor_payload = None
             sensor_data = payload.get('sensor_data', {})
-            knowledge = payload.get('knowledge', {})
-            grid = payload.get('grid', {})
-            
-            analysis = {
-                'requires_adaptation': False,
-                'adaptation_type': None,
-                'reason': None,
-                'knowledge': knowledge,
-                'grid': grid
-            }
             
             mission_in_progress = sensor_data.get('mission_in_progress', False)
             loaded_orders = sensor_data.get('loaded_orders', [])
-            is_at_base = payload.get('at_base', False)
-            
-            # Rule 1: Mission complete
-            if mission_in_progress and not loaded_orders and is_at_base:
-                analysis['requires_adaptation'] = True
-                analysis['adaptation_type'] = 'end_mission'
-                analysis['reason'] = 'Back at base'
-                client.publish(TOPICS['analyze_result'], json.dumps(analysis))
-                print("[Analyze] Decision: end_mission")
-                return
             
-            # Rule 2: At delivery location
-            if payload.get('at_delivery_location') and loaded_orders:
-                analysis['requires_adaptation'] = True
-                analysis['adaptation_type'] = 'deliver'
-                analysis['reason'] = 'At delivery location'
-                client.publish(TOPICS['analyze_result'], json.dumps(analysis))
-                print("[Analyze] Decision: deliver")
-                return
-            
-            # Rule 3: Start mission
-            if payload.get('needs_new_mission') and not mission_in_progress:
-                analysis['requires_adaptation'] = True
-                analysis['adaptation_type'] = 'start_mission'
-                analysis['reason'] = 'Capacity or timeout'
-                client.publish(TOPICS['analyze_result'], json.dumps(analysis))
-                print("[Analyze] Decision: start_mission")
-                return
-            
-            # Rule 4: Path blocked
-            if payload.get('path_blocked') and mission_in_progress:
-                analysis['requires_adaptation'] = True
-                analysis['adaptation_type'] = 'replan'
-                analysis['reason'] = 'Path blocked'
-                client.publish(TOPICS['analyze_result'], json.dumps(analysis))
-                print("[Analyze] Decision: replan (blocked)")
-                return
-            
-            # Rule 5: Obstacle removed
-            if payload.get('obstacle_removed') and mission_in_progress:
-                analysis['requires_adaptation'] = True
-                analysis['adaptation_type'] = 'replan'
-                analysis['reason'] = 'Obstacle removed'
-                client.publish(TOPICS['analyze_result'], json.dumps(analysis))
-                print("[Analyze] Decision: replan (obstacle removed)")
-                return
+            for check, adaptation_type, reason, label in RULES:
+                if check(payload, mission_in_progress, loaded_orders):
+                    last_decision = encode({
+                        'requires_adaptation': True,
+                        'adaptation_type': adaptation_type,
+                        'reason': reason
+                    }).encode('utf-8')
+                    last_label = label
+                    last_monitor_payload = msg.payload
+                    publish(ANALYZE_RESULT, last_decision)
+                    print(f"[Analyze] Decision: {label}")
+                    return
             
             # No adaptation needed
-            client.publish(TOPICS['analyze_result'], json.dumps(analysis))
+            last_decision = CONTINUE
+            last_label = 'continue'
+            last_monitor_payload = msg.payload
+            publish(ANALYZE_RESULT, CONTINUE)
             print("[Analyze] Decision: continue")
     
     except Exception as e:
         print(f"[Analyze] Error: {e}")
 
 
+def on_socket_open(client_obj, userdata, sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def on_connect_fail(client_obj, userdata):
+    print("[Analyze] Waiting for MQTT...")
+
+
 def on_connect(client_obj, userdata, flags, rc):
     print("[Analyze] Connected to MQTT")
-    client_obj.subscribe(TOPICS['monitor_result'])
+    client_obj.subscribe(MONITOR_RESULT)
 
 
 if __name__ == '__main__':
@@ -105,15 +117,12 @@ if __name__ == '__main__':
     
     client = mqtt.Client(client_id=f"analyze-{uuid.uuid4().hex[:8]}")
     client.on_connect = on_connect
+    client.on_socket_open = on_socket_open
+    client.on_connect_fail = on_connect_fail
     client.on_message = handle_message
     
-    while True:
-        try:
-            client.connect(BROKER, PORT, 60)
-            break
-        except:
-            print("[Analyze] Waiting for MQTT...")
-            time.sleep(2)
+    client.reconnect_delay_set(min_delay=1, max_delay=30)
+    client.connect_async(BROKER, PORT, 60)
     
     print("[Analyze] Ready")
-    client.loop_forever()
\ No newline at end of file
+    client.loop_forever(retry_first_connection=True)
\ No newline at end of file
@@ -6,6 +6,8 @@ import json
 import time
 import uuid
 import os
+import socket
+import threading
 
 # Load config
 with open('/app/config.json') as f:
@@ -14,158 +16,296 @@ with open('/app/config.json') as f:
 BROKER = os.environ.get('MQTT_BROKER', CONFIG['mqtt']['broker'])
 PORT = CONFIG['mqtt']['port']
 TOPICS = CONFIG['topics']
+SYSTEM_INIT = TOPICS['system_init']
+SYSTEM_INIT_ACK = TOPICS['system_init_ack']
+SYSTEM_RESET = TOPICS['system_reset']
+SYSTEM_SYNC = TOPICS['system_sync']
+USER_TOGGLE_OBSTACLE = TOPICS['user_toggle_obstacle']
+ENVIRONMENT_MOVE = TOPICS['environment_move']
+ROBOT_STEP = TOPICS['robot_step']
+ENVIRONMENT_LOAD = TOPICS['environment_load']
+ENVIRONMENT_DELIVER = TOPICS['environment_deliver']
+ENVIRONMENT_CLEAR = TOPICS['environment_clear']
+ENVIRONMENT_UPDATE = TOPICS['environment_update']
+ENVIRONMENT_DELTA = TOPICS['environment_delta']
+BASE_LOCATION = tuple(CONFIG['robot']['base_location'])
+
+encode = json.JSONEncoder(separators=(',', ':')).encode
 
 OBSTACLE = 1
 BASE = 2
 DELIVERY = 3
 
+DELIVERY_LOCATIONS = [
+    [4, 4], [8, 2], [12, 4], [2, 10], [6, 12], [10, 10], [13, 12],
+    [0, 15], [14, 2], [14, 18], [3, 19], [11, 20]
+]
+DELIVERY_SET = frozenset((r, c) for r, c in DELIVERY_LOCATIONS)
+
+OBSTACLE_LOCATIONS = (
+    (4, 0), (5, 0), (0, 3), (0, 4), (2, 3), (3, 3), (5, 2), (6, 2),
+    (2, 6), (3, 6), (6, 5), (7, 5), (7, 6), (9, 1), (10, 1), (10, 2),
+    (9, 4), (9, 5), (12, 1), (13, 1), (11, 6), (12, 6), (5, 7), (6, 7),
+    (14, 4), (14, 5), (0, 9), (1, 9), (3, 9), (4, 9), (0, 13), (1, 13),
+    (3, 13), (4, 13), (7, 9), (8, 9), (7, 14), (8, 14), (5, 10), (5, 11),
+    (9, 12), (9, 13), (11, 8), (12, 8), (11, 14), (12, 14), (14, 9), (14, 10),
+    (14, 13), (14, 14), (6, 15), (6, 16), (10, 15), (10, 16), (0, 17), (1, 17),
+    (0, 21), (1, 21), (2, 17), (2, 18), (4, 20), (4, 21), (6, 18), (6, 19),
+    (8, 17), (9, 17), (8, 21), (9, 21), (12, 17), (12, 18), (12, 20), (12, 21),
+)
+
+# Coalesce bursts of changes into one publish. State is sent at QoS 0 and never
+# retained: the next flush supersedes a lost message, and a retained snapshot
+# would be stale once deltas follow it (late joiners use system_sync instead).
+FLUSH_INTERVAL = 0.05
+MAX_COALESCE = 16
+
+# Sections that change at runtime; the rest of the grid only changes on init/reset
+SNAPSHOT = 'snapshot'
+ROBOT = 'robot'
+DYNAMIC_OBSTACLES = 'dynamic_obstacles'
+
 # State
 grid = None
 robot = None
+dynamic_set = set()
+loaded_index = {}
 client = None
+state_lock = threading.Lock()
+pending_changes = 0
+dirty_sections = set()
 
 
-def create_initial_grid():
+def build_static_rows():
     width = CONFIG['grid']['width']
     height = CONFIG['grid']['height']
-    g = [[0 for _ in range(width)] for _ in range(height)]
-    
-    base_location = CONFIG['robot']['base_location']
-    for r in range(2):
-        for c in range(2):
-            g[r][c] = BASE
     
-    delivery_locations = [
-        [4, 4], [8, 2], [12, 4], [2, 10], [6, 12], [10, 10], [13, 12],
-        [0, 15], [14, 2], [14, 18], [3, 19], [11, 20]
-    ]
-    for loc in delivery_locations:
-        if 0 <= loc[0] < height and 0 <= loc[1] < width:
-            g[loc[0]][loc[1]] = DELIVERY
+    # Cell kinds keyed by (row, col); obstacles never overwrite base/delivery
+    cells = {(r, c): BASE for r in range(2) for c in range(2)}
+    for r, c in DELIVERY_LOCATIONS:
+        cells[(r, c)] = DELIVERY
     
-    obstacles = [
-        [4, 0], [5, 0], [0, 3], [0, 4], [2, 3], [3, 3], [5, 2], [6, 2],
-        [2, 6], [3, 6], [6, 5], [7, 5], [7, 6], [9, 1], [10, 1], [10, 2],
-        [9, 4], [9, 5], [12, 1], [13, 1], [11, 6], [12, 6], [5, 7], [6, 7],
-        [14, 4], [14, 5], [0, 9], [1, 9], [3, 9], [4, 9], [0, 13], [1, 13],
-        [3, 13], [4, 13], [7, 9], [8, 9], [7, 14], [8, 14], [5, 10], [5, 11],
-        [9, 12], [9, 13], [11, 8], [12, 8], [11, 14], [12, 14], [14, 9], [14, 10],
-        [14, 13], [14, 14], [6, 15], [6, 16], [10, 15], [10, 16], [0, 17], [1, 17],
-        [0, 21], [1, 21], [2, 17], [2, 18], [4, 20], [4, 21], [6, 18], [6, 19],
-        [8, 17], [9, 17], [8, 21], [9, 21], [12, 17], [12, 18], [12, 20], [12, 21],
-    ]
-    for pos in obstacles:
-        if 0 <= pos[0] < height and 0 <= pos[1] < width and g[pos[0]][pos[1]] == 0:
-            g[pos[0]][pos[1]] = OBSTACLE
+    for r, c in OBSTACLE_LOCATIONS:
+        cells.setdefault((r, c), OBSTACLE)
     
+    # Out-of-range entries are never read, so no per-cell bounds checks
+    return [[cells.get((r, c), 0) for c in range(width)] for r in range(height)]
+
+
+def create_initial_grid():
     return {
-        'width': width,
-        'height': height,
-        'grid': g,
-        'base_location': base_location,
-        'delivery_locations': delivery_locations,
+        'width': CONFIG['grid']['width'],
+        'height': CONFIG['grid']['height'],
+        'grid': STATIC_ROWS,
+        'base_location': BASE_LOCATION,
+        'delivery_locations': DELIVERY_LOCATIONS,
         'dynamic_obstacles': []
     }
 
 
 def create_initial_robot():
     return {
-        'position': list(CONFIG['robot']['base_location']),
+        'position': BASE_LOCATION,
         'loaded_orders': [],
         'is_at_base': True
     }
 
 
+def encode_static(grid):
+    # JSON members of the grid that never change between init/reset, without braces
+    return encode({k: v for k, v in grid.items() if k != 'dynamic_obstacles'})[1:-1]
+
+
+# The static layout is the same on every init/reset, so it is built once.
+# STATIC_ROWS is shared by every grid snapshot and never mutated.
+STATIC_ROWS = build_static_rows()
+STATIC_CELLS = bytes(v for row in STATIC_ROWS for v in row)
+STATIC_JSON = encode_static(create_initial_grid())
+
+
 def publish_state():
     global grid, robot, client
     if grid and robot:
-        client.publish(TOPICS['environment_update'], json.dumps({
-            'grid': grid,
-            'robot': robot
-        }))
+        # Splice the cached static members in; only the runtime sections are encoded
+        client.publish(ENVIRONMENT_UPDATE, '{"grid":{%s,"dynamic_obstacles":%s},"robot":%s}' % (
+            STATIC_JSON,
+            encode(grid['dynamic_obstacles']),
+            encode(robot)
+        ), qos=0, retain=False)
 
 
-def handle_message(client_obj, userdata, msg):
-    global grid, robot
+def publish_delta(sections):
+    global grid, robot, client
+    if grid and robot:
+        delta = {}
+        if ROBOT in sections:
+            delta['robot'] = robot
+        if DYNAMIC_OBSTACLES in sections:
+            delta['dynamic_obstacles'] = grid['dynamic_obstacles']
+        client.publish(ENVIRONMENT_DELTA, encode(delta), qos=0, retain=False)
+
+
+def mark_dirty(section):
+    global pending_changes
+    pending_changes += 1
+    dirty_sections.add(section)
+    if pending_changes >= MAX_COALESCE:
+        flush_state()
+
+
+def flush_state():
+    global pending_changes
+    if pending_changes:
+        pending_changes = 0
+        if SNAPSHOT in dirty_sections:
+            publish_state()
+        else:
+            publish_delta(dirty_sections)
+        dirty_sections.clear()
+
+
+def flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        with state_lock:
+            flush_state()
+
+
+def load_initial_state():
+    global grid, robot, dynamic_set
+    grid = create_initial_grid()
+    robot = create_initial_robot()
+    dynamic_set = set()
+    loaded_index.clear()
+
+
+def handle_init(payload):
+    load_initial_state()
+    print("[Environment] Initialized")
+    mark_dirty(SNAPSHOT)
+    flush_state()
+    client.publish(SYSTEM_INIT_ACK, encode({'service': 'environment'}))
+
+
+def handle_reset(payload):
+    load_initial_state()
+    print("[Environment] Reset")
+    mark_dirty(SNAPSHOT)
+    flush_state()
+
+
+def handle_sync(payload):
+    # A service (re)connected and needs the full state
+    mark_dirty(SNAPSHOT)
+    flush_state()
+
+
+def handle_toggle_obstacle(payload):
+    if not grid:
+        return
+    pos = payload.get('position')
+    row, col = pos[0], pos[1]
+    width = grid['width']
+    if not ((row | col) >= 0 and row < grid['height'] and col < width):
+        return
     
+    if (row, col) in dynamic_set:
+        dynamic_set.discard((row, col))
+        grid['dynamic_obstacles'].remove(pos)
+        print(f"[Environment] Removed obstacle {pos}")
+    else:
+        if row <= 1 and col <= 1:
+            return
+        if (row, col) in DELIVERY_SET:
+            return
+        if STATIC_CELLS[row * width + col] == OBSTACLE:
+            return
+        if robot and (row, col) == robot['position']:
+            return
+        dynamic_set.add((row, col))
+        grid['dynamic_obstacles'].append(pos)
+        print(f"[Environment] Added obstacle {pos}")
+    mark_dirty(DYNAMIC_OBSTACLES)
+
+
+def handle_move(payload):
+    if not robot:
+        return
+    # Positions are kept as tuples; they encode to the same JSON arrays
+    r, c = payload['position']
+    robot['position'] = (r, c)
+    robot['is_at_base'] = (robot['position'] == BASE_LOCATION)
+    mark_dirty(ROBOT)
+
+
+def handle_load(payload):
+    if not robot:
+        return
+    # A mission start loads all of its orders in one message
+    orders = payload['orders'] if 'orders' in payload else [payload['order']]
+    for order in orders:
+        robot['loaded_orders'].append(order)
+        loaded_index[order['order_id']] = order
+    mark_dirty(ROBOT)
+
+
+def handle_deliver(payload):
+    if not robot:
+        return
+    order = loaded_index.pop(payload['order_id'], None)
+    if order is None:
+        return
+    robot['loaded_orders'].remove(order)
+    mark_dirty(ROBOT)
+
+
+def handle_clear(payload):
+    if not robot:
+        return
+    robot['loaded_orders'] = []
+    loaded_index.clear()
+    mark_dirty(ROBOT)
+
+
+HANDLERS = {
+    SYSTEM_INIT: handle_init,
+    SYSTEM_RESET: handle_reset,
+    SYSTEM_SYNC: handle_sync,
+    USER_TOGGLE_OBSTACLE: handle_toggle_obstacle,
+    ENVIRONMENT_MOVE: handle_move,
+    ROBOT_STEP: handle_move,
+    ENVIRONMENT_LOAD: handle_load,
+    ENVIRONMENT_DELIVER: handle_deliver,
+    ENVIRONMENT_CLEAR: handle_clear
+}
+
+
+def handle_message(client_obj, userdata, msg):
     try:
-        topic = msg.topic
-        payload = json.loads(msg.payload.decode('utf-8')) if msg.payload else {}
-        
-        if topic == TOPICS['system_init']:
-            grid = create_initial_grid()
-            robot = create_initial_robot()
-            print("[Environment] Initialized")
-            publish_state()
+        handler = HANDLERS.get(msg.topic)
+        if not handler:
+            return
+        payload = json.loads(msg.payload) if msg.payload else {}
         
-        elif topic == TOPICS['system_reset']:
-            grid = create_initial_grid()
-            robot = create_initial_robot()
-            print("[Environment] Reset")
-            publish_state()
-        
-        elif topic == TOPICS['user_toggle_obstacle']:
-            if not grid:
-                return
-            pos = payload.get('position')
-            row, col = pos[0], pos[1]
-            
-            if pos in grid['dynamic_obstacles']:
-                grid['dynamic_obstacles'].remove(pos)
-                print(f"[Environment] Removed obstacle {pos}")
-            else:
-                if row <= 1 and col <= 1:
-                    return
-                if pos in grid['delivery_locations']:
-                    return
-                if grid['grid'][row][col] == OBSTACLE:
-                    return
-                if robot and pos == robot['position']:
-                    return
-                grid['dynamic_obstacles'].append(pos)
-                print(f"[Environment] Added obstacle {pos}")
-            publish_state()
-        
-        elif topic == TOPICS['environment_move']:
-            if not robot:
-                return
-            robot['position'] = payload['position']
-            base = CONFIG['robot']['base_location']
-            robot['is_at_base'] = (robot['position'] == base)
-            publish_state()
-        
-        elif topic == TOPICS['environment_load']:
-            if not robot:
-                return
-            robot['loaded_orders'].append(payload['order'])
-            publish_state()
-        
-        elif topic == TOPICS['environment_deliver']:
-            if not robot:
-                return
-            order_id = payload['order_id']
-            robot['loaded_orders'] = [o for o in robot['loaded_orders'] if o['order_id'] != order_id]
-            publish_state()
-        
-        elif topic == TOPICS['environment_clear']:
-            if not robot:
-                return
-            robot['loaded_orders'] = []
-            publish_state()
+        with state_lock:
+            handler(payload)
     
     except Exception as e:
         print(f"[Environment] Error: {e}")
 
 
+def on_socket_open(client_obj, userdata, sock):
+    # Send small back-to-back publishes immediately instead of waiting on Nagle
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def on_connect_fail(client_obj, userdata):
+    print("[Environment] Waiting for MQTT...")
+
+
 def on_connect(client_obj, userdata, flags, rc):
     print("[Environment] Connected to MQTT")
-    client_obj.subscribe(TOPICS['system_init'])
-    client_obj.subscribe(TOPICS['system_reset'])
-    client_obj.subscribe(TOPICS['user_toggle_obstacle'])
-    client_obj.subscribe(TOPICS['environment_move'])
-    client_obj.subscribe(TOPICS['environment_load'])
-    client_obj.subscribe(TOPICS['environment_deliver'])
-    client_obj.subscribe(TOPICS['environment_clear'])
+    client_obj.subscribe([(topic, 0) for topic in HANDLERS])
 
 
 if __name__ == '__main__':
@@ -173,15 +313,14 @@ if __name__ == '__main__':
     
     client = mqtt.Client(client_id=f"environment-{uuid.uuid4().hex[:8]}")
     client.on_connect = on_connect
+    client.on_socket_open = on_socket_open
+    client.on_connect_fail = on_connect_fail
     client.on_message = handle_message
     
-    while True:
-        try:
-            client.connect(BROKER, PORT, 60)
-            break
-        except:
-            print("[Environment] Waiting for MQTT...")
-            time.sleep(2)
+    # Connect from the network loop, retrying with backoff until the broker is up
+    client.reconnect_delay_set(min_delay=1, max_delay=30)
+    client.connect_async(BROKER, PORT, 60)
     
     print("[Environment] Ready")
-    client.loop_forever()
\ No newline at end of file
+    client.loop_start()
+    flush_loop()
\ No newline at end of file
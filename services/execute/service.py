@@ -6,6 +6,9 @@ import json
 import time
 import uuid
 import os
+import socket
+import queue
+import threading
 
 # Load config
 with open('/app/config.json') as f:
@@ -14,49 +17,131 @@ with open('/app/config.json') as f:
 BROKER = os.environ.get('MQTT_BROKER', CONFIG['mqtt']['broker'])
 PORT = CONFIG['mqtt']['port']
 TOPICS = CONFIG['topics']
+PLAN_RESULT = TOPICS['plan_result']
+KNOWLEDGE_UPDATE = TOPICS['knowledge_update']
+KNOWLEDGE_DELTA = TOPICS['knowledge_delta']
+ENVIRONMENT_UPDATE = TOPICS['environment_update']
+ENVIRONMENT_DELTA = TOPICS['environment_delta']
+ROBOT_STEP = TOPICS['robot_step']
+ENVIRONMENT_LOAD = TOPICS['environment_load']
+KNOWLEDGE_SET = TOPICS['knowledge_set']
+ENVIRONMENT_DELIVER = TOPICS['environment_deliver']
+ENVIRONMENT_CLEAR = TOPICS['environment_clear']
+SYSTEM_SYNC = TOPICS['system_sync']
+
+encode = json.JSONEncoder(separators=(',', ':')).encode
 
 OBSTACLE = 1
 
+# Plan's prebuilt continue action, matched byte-for-byte
+CONTINUE = b'{"action":"continue"}'
+
 # State cache
 knowledge = None
 grid = None
+static_blocked = bytearray()
+blocked = bytearray()
 client = None
+outbox = queue.Queue()
+
+# robot_step message reused every move; it is encoded before execute_continue returns
+step_knowledge = {
+    'robot_position': None,
+    'current_plan_index': 0,
+    'total_distance_traveled': 0
+}
+step_message = {'position': None, 'knowledge': step_knowledge}
+
+
+def publish(topic, payload):
+    # Commands leave from publish_loop so the network thread never blocks on a send
+    outbox.put((topic, payload))
+
+
+def publish_loop():
+    # Single consumer keeps commands in the order they were issued
+    while True:
+        topic, payload = outbox.get()
+        client.publish(topic, payload, qos=0, retain=False)
+
+
+def set_knowledge(updates):
+    # Apply plain fields to the local cache right away so the next action does not
+    # wait for Knowledge's round trip; the delta that follows carries the same values.
+    # Deltas are merged without an ordering check. That relies on Knowledge flushing
+    # (10 ms) far faster than the MAPE cycle (400 ms), so a delta for an earlier change
+    # always lands before the next local update.
+    # List ops are left to Knowledge, Execute never reads the lists they edit.
+    if knowledge:
+        for key, value in updates.items():
+            if key != 'ops' and key in knowledge:
+                knowledge[key] = value
+    publish(KNOWLEDGE_SET, encode(updates))
+
+
+def build_static_blocked(grid):
+    # Row-major flat cells: 1 for static obstacles
+    return bytearray(cell == OBSTACLE for row in grid.get('grid', []) for cell in row)
+
+
+def build_blocked(grid):
+    # Static mask with the current dynamic obstacles merged in
+    width = grid.get('width', 0)
+    merged = static_blocked[:]
+    for r, c in grid.get('dynamic_obstacles', []):
+        merged[r * width + c] = 1
+    return merged
+
+
+def is_valid_position(pos):
+    r, c = pos
+    width = grid.get('width', 0)
+    # (r | c) is negative iff either coordinate is
+    if not ((r | c) >= 0 and r < grid.get('height', 0) and c < width):
+        return False
+    return not blocked[r * width + c]
 
 
 def handle_message(client_obj, userdata, msg):
-    global knowledge, grid, client
+    global knowledge, grid, static_blocked, blocked, client
     
     try:
         topic = msg.topic
-        payload = json.loads(msg.payload.decode('utf-8')) if msg.payload else {}
         
-        if topic == TOPICS['knowledge_update']:
+        # A continue while no mission is running moves nothing; skip decoding it
+        if topic == PLAN_RESULT and msg.payload == CONTINUE:
+            if not knowledge or knowledge.get('is_stuck') or not knowledge.get('mission_in_progress'):
+                return
+        
+        payload = json.loads(msg.payload) if msg.payload else {}
+        
+        if topic == KNOWLEDGE_UPDATE:
             knowledge = payload
         
-        elif topic == TOPICS['environment_update']:
+        elif topic == KNOWLEDGE_DELTA:
+            if knowledge:
+                knowledge.update(payload)
+        
+        elif topic == ENVIRONMENT_UPDATE:
             grid = payload.get('grid', {})
+            static_blocked = build_static_blocked(grid)
+            blocked = build_blocked(grid)
         
-        elif topic == TOPICS['plan_result']:
-            action = payload.get('action')
-            
-            if action == 'continue':
-                execute_continue()
-            elif action == 'start_mission':
-                execute_start(payload)
-            elif action == 'replan':
-                execute_replan(payload)
-            elif action == 'deliver':
-                execute_deliver(payload)
-            elif action == 'end_mission':
-                execute_end()
-            elif action == 'wait':
-                execute_wait(payload)
+        elif topic == ENVIRONMENT_DELTA:
+            if grid and 'dynamic_obstacles' in payload:
+                grid['dynamic_obstacles'] = payload['dynamic_obstacles']
+                blocked = build_blocked(grid)
+        
+        elif topic == PLAN_RESULT:
+            action = ACTIONS.get(payload.get('action'))
+            if action:
+                action(payload)
     
     except Exception as e:
         print(f"[Execute] Error: {e}")
 
 
-def execute_continue():
+def execute_continue(payload):
     global knowledge, grid, client
     
     if not knowledge:
@@ -79,24 +164,16 @@ def execute_continue():
     next_pos = plan[idx]
     
     # Validate
-    if grid:
-        r, c = next_pos
-        grid_data = grid.get('grid', [[]])
-        if r < len(grid_data) and c < len(grid_data[0]):
-            if grid_data[r][c] == OBSTACLE:
-                return
-        if next_pos in grid.get('dynamic_obstacles', []):
-            return
-    
-    # Command Environment
-    client.publish(TOPICS['environment_move'], json.dumps({'position': next_pos}))
+    if grid and not is_valid_position(next_pos):
+        return
     
-    # Update Knowledge
-    client.publish(TOPICS['knowledge_set'], json.dumps({
-        'robot_position': next_pos,
-        'current_plan_index': idx + 1,
-        'total_distance_traveled': knowledge.get('total_distance_traveled', 0) + 1
-    }))
+    # Command Environment and update Knowledge in one message
+    step_message['position'] = next_pos
+    step_knowledge['robot_position'] = next_pos
+    step_knowledge['current_plan_index'] = idx + 1
+    step_knowledge['total_distance_traveled'] = knowledge.get('total_distance_traveled', 0) + 1
+    publish(ROBOT_STEP, encode(step_message))
+    knowledge.update(step_knowledge)
     
     print(f"[Execute] Move to {next_pos}")
 
@@ -109,17 +186,14 @@ def execute_start(payload):
     path = payload['path']
     
     # Load orders
-    for order in orders:
-        client.publish(TOPICS['environment_load'], json.dumps({'order': order}))
-    
-    # Update Knowledge - store original_last_delivery for path coloring
-    loaded_ids = {o['order_id'] for o in orders}
-    pending = [o for o in knowledge.get('pending_orders', []) if o['order_id'] not in loaded_ids]
+    publish(ENVIRONMENT_LOAD, encode({'orders': orders}))
     
+    # Update Knowledge - store original_last_delivery for path coloring.
+    # Loaded orders are removed from pending by id, not by sending the filtered list.
     original_last = sequence[-1] if sequence else None
     
-    client.publish(TOPICS['knowledge_set'], json.dumps({
-        'pending_orders': pending,
+    set_knowledge({
+        'ops': [{'op': 'remove_orders', 'key': 'pending_orders', 'order_ids': [o['order_id'] for o in orders]}],
         'loaded_orders': orders,
         'current_plan': path,
         'current_plan_index': 0,
@@ -128,7 +202,7 @@ def execute_start(payload):
         'mission_in_progress': True,
         'is_stuck': False,
         'last_mission_start_time': time.time()
-    }))
+    })
     
     print(f"[Execute] Started mission: {len(orders)} orders")
 
@@ -148,7 +222,7 @@ def execute_replan(payload):
     if sequence:
         updates['delivery_sequence'] = sequence
     
-    client.publish(TOPICS['knowledge_set'], json.dumps(updates))
+    set_knowledge(updates)
     print(f"[Execute] Replanned: {len(path)} steps")
 
 
@@ -160,31 +234,27 @@ def execute_deliver(payload):
     loc = order['delivery_location']
     
     # Command Environment
-    client.publish(TOPICS['environment_deliver'], json.dumps({'order_id': order_id}))
+    publish(ENVIRONMENT_DELIVER, encode({'order_id': order_id}))
     
-    # Update Knowledge
+    # Update Knowledge - send the list edits, not the rewritten lists
     delivery_time = time.time() - order['timestamp']
-    loaded = [o for o in knowledge.get('loaded_orders', []) if o['order_id'] != order_id]
-    completed = knowledge.get('completed_orders', []) + [order]
-    times = knowledge.get('delivery_times', []) + [delivery_time]
-    sequence = [s for s in knowledge.get('delivery_sequence', []) if s != loc]
-    
-    client.publish(TOPICS['knowledge_set'], json.dumps({
-        'loaded_orders': loaded,
-        'completed_orders': completed,
-        'delivery_times': times,
-        'delivery_sequence': sequence
-    }))
+    
+    set_knowledge({'ops': [
+        {'op': 'remove_orders', 'key': 'loaded_orders', 'order_ids': [order_id]},
+        {'op': 'increment', 'key': 'completed_count', 'value': 1},
+        {'op': 'increment', 'key': 'total_delivery_time', 'value': delivery_time},
+        {'op': 'discard', 'key': 'delivery_sequence', 'value': loc}
+    ]})
     
     print(f"[Execute] Delivered {order_id}")
 
 
-def execute_end():
+def execute_end(payload):
     global client
     
-    client.publish(TOPICS['environment_clear'], json.dumps({}))
+    publish(ENVIRONMENT_CLEAR, encode({}))
     
-    client.publish(TOPICS['knowledge_set'], json.dumps({
+    set_knowledge({
         'mission_in_progress': False,
         'current_plan': None,
         'current_plan_index': 0,
@@ -192,22 +262,45 @@ def execute_end():
         'original_last_delivery': None,
         'loaded_orders': [],
         'is_stuck': False
-    }))
+    })
     
     print("[Execute] Mission ended")
 
 
 def execute_wait(payload):
     global client
-    client.publish(TOPICS['knowledge_set'], json.dumps({'is_stuck': True}))
+    set_knowledge({'is_stuck': True})
     print(f"[Execute] Waiting: {payload.get('reason')}")
 
 
+ACTIONS = {
+    'continue': execute_continue,
+    'start_mission': execute_start,
+    'replan': execute_replan,
+    'deliver': execute_deliver,
+    'end_mission': execute_end,
+    'wait': execute_wait
+}
+
+
+def on_socket_open(client_obj, userdata, sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def on_connect_fail(client_obj, userdata):
+    print("[Execute] Waiting for MQTT...")
+
+
 def on_connect(client_obj, userdata, flags, rc):
     print("[Execute] Connected to MQTT")
-    client_obj.subscribe(TOPICS['knowledge_update'])
-    client_obj.subscribe(TOPICS['environment_update'])
-    client_obj.subscribe(TOPICS['plan_result'])
+    client_obj.subscribe([
+        (KNOWLEDGE_UPDATE, 0),
+        (KNOWLEDGE_DELTA, 0),
+        (ENVIRONMENT_UPDATE, 0),
+        (ENVIRONMENT_DELTA, 0),
+        (PLAN_RESULT, 0)
+    ])
+    client_obj.publish(SYSTEM_SYNC, encode({}), qos=0, retain=False)
 
 
 if __name__ == '__main__':
@@ -215,15 +308,13 @@ if __name__ == '__main__':
     
     client = mqtt.Client(client_id=f"execute-{uuid.uuid4().hex[:8]}")
     client.on_connect = on_connect
+    client.on_socket_open = on_socket_open
+    client.on_connect_fail = on_connect_fail
     client.on_message = handle_message
     
-    while True:
-        try:
-            client.connect(BROKER, PORT, 60)
-            break
-        except:
-            print("[Execute] Waiting for MQTT...")
-            time.sleep(2)
+    client.reconnect_delay_set(min_delay=1, max_delay=30)
+    client.connect_async(BROKER, PORT, 60)
     
     print("[Execute] Ready")
-    client.loop_forever()
\ No newline at end of file
+    threading.Thread(target=publish_loop, daemon=True).start()
+    client.loop_forever(retry_first_connection=True)
\ No newline at end of file
@@ -6,6 +6,9 @@ import json
 import time
 import uuid
 import os
+import socket
+import threading
+import queue
 
 # Load config
 with open('/app/config.json') as f:
@@ -14,10 +17,29 @@ with open('/app/config.json') as f:
 BROKER = os.environ.get('MQTT_BROKER', CONFIG['mqtt']['broker'])
 PORT = CONFIG['mqtt']['port']
 TOPICS = CONFIG['topics']
+KNOWLEDGE_UPDATE = TOPICS['knowledge_update']
+KNOWLEDGE_DELTA = TOPICS['knowledge_delta']
+SYSTEM_INIT = TOPICS['system_init']
+SYSTEM_INIT_ACK = TOPICS['system_init_ack']
+SYSTEM_RESET = TOPICS['system_reset']
+SYSTEM_SYNC = TOPICS['system_sync']
+USER_ADD_ORDER = TOPICS['user_add_order']
+KNOWLEDGE_SET = TOPICS['knowledge_set']
+ROBOT_STEP = TOPICS['robot_step']
+
+encode = json.JSONEncoder(separators=(',', ':')).encode
+
+# Debounce window for knowledge_update after a change
+FLUSH_INTERVAL = 0.01
 
 # State
 knowledge = None
 client = None
+inbox = queue.Queue()
+state_lock = threading.Lock()
+state_dirty = False
+snapshot_due = False
+dirty_keys = set()
 
 
 def create_initial_knowledge():
@@ -28,7 +50,7 @@ def create_initial_knowledge():
         'robot_position': list(CONFIG['robot']['base_location']),
         'pending_orders': [],
         'loaded_orders': [],
-        'completed_orders': [],
+        'completed_count': 0,
         'current_plan': None,
         'current_plan_index': 0,
         'delivery_sequence': [],
@@ -38,14 +60,75 @@ def create_initial_knowledge():
         'last_mission_start_time': time.time(),
         'total_distance_traveled': 0,
         'number_of_replans': 0,
-        'delivery_times': []
+        'total_delivery_time': 0.0
     }
 
 
 def publish_state():
     global knowledge, client
     if knowledge:
-        client.publish(TOPICS['knowledge_update'], json.dumps(knowledge))
+        client.publish(KNOWLEDGE_UPDATE, encode(knowledge))
+
+
+def publish_delta(keys):
+    global knowledge, client
+    if knowledge:
+        client.publish(KNOWLEDGE_DELTA, encode({k: knowledge[k] for k in keys}))
+
+
+def mark_dirty(*keys):
+    # No keys means the whole state is due (init/reset/sync)
+    global state_dirty, snapshot_due
+    state_dirty = True
+    if keys:
+        dirty_keys.update(keys)
+    else:
+        snapshot_due = True
+
+
+def flush_state():
+    global state_dirty, snapshot_due
+    if state_dirty:
+        state_dirty = False
+        if snapshot_due:
+            publish_state()
+        elif dirty_keys:
+            publish_delta(dirty_keys)
+        snapshot_due = False
+        dirty_keys.clear()
+
+
+def flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        with state_lock:
+            flush_state()
+
+
+def apply_ops(ops):
+    # List edits sent instead of whole rewritten lists; returns the keys actually changed
+    touched = []
+    for op in ops:
+        key = op['key']
+        if key not in knowledge:
+            continue
+        if op['op'] == 'increment':
+            if not op['value']:
+                continue
+            knowledge[key] += op['value']
+        elif op['op'] == 'remove_orders':
+            order_ids = set(op['order_ids'])
+            kept = [o for o in knowledge[key] if o['order_id'] not in order_ids]
+            if len(kept) == len(knowledge[key]):
+                continue
+            knowledge[key] = kept
+        elif op['op'] == 'discard':
+            kept = [v for v in knowledge[key] if v != op['value']]
+            if len(kept) == len(knowledge[key]):
+                continue
+            knowledge[key] = kept
+        touched.append(key)
+    return touched
 
 
 def handle_message(client, userdata, msg):
@@ -53,50 +136,87 @@ def handle_message(client, userdata, msg):
     
     try:
         topic = msg.topic
-        payload = json.loads(msg.payload.decode('utf-8')) if msg.payload else {}
+        payload = json.loads(msg.payload) if msg.payload else {}
         
-        if topic == TOPICS['system_init']:
-            knowledge = create_initial_knowledge()
-            print("[Knowledge] Initialized")
-            publish_state()
-        
-        elif topic == TOPICS['system_reset']:
-            knowledge = create_initial_knowledge()
-            print("[Knowledge] Reset")
-            publish_state()
-        
-        elif topic == TOPICS['user_add_order']:
-            if not knowledge:
-                return
-            order = {
-                'order_id': payload['order_id'],
-                'delivery_location': payload['delivery_location'],
-                'timestamp': payload.get('timestamp', time.time())
-            }
-            knowledge['pending_orders'].append(order)
-            if len(knowledge['pending_orders']) == 1:
-                knowledge['last_mission_start_time'] = time.time()
-            print(f"[Knowledge] Added order {order['order_id']}")
-            publish_state()
-        
-        elif topic == TOPICS['knowledge_set']:
-            if not knowledge:
-                return
-            for key, value in payload.items():
-                if key in knowledge:
-                    knowledge[key] = value
-            publish_state()
+        with state_lock:
+            if topic == SYSTEM_INIT:
+                knowledge = create_initial_knowledge()
+                print("[Knowledge] Initialized")
+                mark_dirty()
+                flush_state()
+                client.publish(SYSTEM_INIT_ACK, encode({'service': 'knowledge'}))
+            
+            elif topic == SYSTEM_RESET:
+                knowledge = create_initial_knowledge()
+                print("[Knowledge] Reset")
+                mark_dirty()
+                flush_state()
+            
+            elif topic == SYSTEM_SYNC:
+                # A service (re)connected and needs the full state
+                mark_dirty()
+                flush_state()
+            
+            elif topic == USER_ADD_ORDER:
+                if not knowledge:
+                    return
+                now = time.time()
+                order = {
+                    'order_id': payload['order_id'],
+                    'delivery_location': payload['delivery_location'],
+                    'timestamp': payload.get('timestamp', now)
+                }
+                knowledge['pending_orders'].append(order)
+                if len(knowledge['pending_orders']) == 1:
+                    knowledge['last_mission_start_time'] = now
+                print(f"[Knowledge] Added order {order['order_id']}")
+                mark_dirty('pending_orders', 'last_mission_start_time')
+            
+            elif topic == KNOWLEDGE_SET or topic == ROBOT_STEP:
+                if not knowledge:
+                    return
+                # A robot step carries its knowledge updates next to the move command
+                updates = payload.get('knowledge', {}) if topic == ROBOT_STEP else payload
+                # Values equal to the current ones are not republished
+                changed = [key for key in updates if key in knowledge and knowledge[key] != updates[key]]
+                for key in changed:
+                    knowledge[key] = updates[key]
+                changed += apply_ops(updates.get('ops', []))
+                if changed:
+                    mark_dirty(*changed)
     
     except Exception as e:
         print(f"[Knowledge] Error: {e}")
 
 
+def enqueue_message(client, userdata, msg):
+    # Decoding and state updates happen in process_loop, off the network thread
+    inbox.put(msg)
+
+
+def process_loop():
+    while True:
+        handle_message(client, None, inbox.get())
+
+
+def on_socket_open(client_obj, userdata, sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def on_connect_fail(client, userdata):
+    print("[Knowledge] Waiting for MQTT...")
+
+
 def on_connect(client, userdata, flags, rc):
     print(f"[Knowledge] Connected to MQTT")
-    client.subscribe(TOPICS['system_init'])
-    client.subscribe(TOPICS['system_reset'])
-    client.subscribe(TOPICS['user_add_order'])
-    client.subscribe(TOPICS['knowledge_set'])
+    client.subscribe([
+        (SYSTEM_INIT, 0),
+        (SYSTEM_RESET, 0),
+        (SYSTEM_SYNC, 0),
+        (USER_ADD_ORDER, 0),
+        (KNOWLEDGE_SET, 0),
+        (ROBOT_STEP, 0)
+    ])
 
 
 if __name__ == '__main__':
@@ -104,15 +224,14 @@ if __name__ == '__main__':
     
     client = mqtt.Client(client_id=f"knowledge-{uuid.uuid4().hex[:8]}")
     client.on_connect = on_connect
-    client.on_message = handle_message
+    client.on_socket_open = on_socket_open
+    client.on_connect_fail = on_connect_fail
+    client.on_message = enqueue_message
     
-    while True:
-        try:
-            client.connect(BROKER, PORT, 60)
-            break
-        except:
-            print("[Knowledge] Waiting for MQTT...")
-            time.sleep(2)
+    client.reconnect_delay_set(min_delay=1, max_delay=30)
+    client.connect_async(BROKER, PORT, 60)
     
     print("[Knowledge] Ready")
-    client.loop_forever()
\ No newline at end of file
+    client.loop_start()
+    threading.Thread(target=process_loop, daemon=True).start()
+    flush_loop()
\ No newline at end of file
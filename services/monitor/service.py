@@ -6,6 +6,8 @@ import json
 import time
 import uuid
 import os
+import socket
+import queue
 
 # Load config
 with open('/app/config.json') as f:
@@ -14,33 +16,170 @@ with open('/app/config.json') as f:
 BROKER = os.environ.get('MQTT_BROKER', CONFIG['mqtt']['broker'])
 PORT = CONFIG['mqtt']['port']
 TOPICS = CONFIG['topics']
+MONITOR_REQUEST = TOPICS['monitor_request']
+KNOWLEDGE_UPDATE = TOPICS['knowledge_update']
+KNOWLEDGE_DELTA = TOPICS['knowledge_delta']
+ENVIRONMENT_UPDATE = TOPICS['environment_update']
+ENVIRONMENT_DELTA = TOPICS['environment_delta']
+SYSTEM_RESET = TOPICS['system_reset']
+MONITOR_RESULT = TOPICS['monitor_result']
+SYSTEM_SYNC = TOPICS['system_sync']
+
+encode = json.JSONEncoder(separators=(',', ':')).encode
+
+OBSTACLE = 1
+
+# Knowledge fields read by the monitor tick, with their defaults (immutable, as instances share them)
+KNOWLEDGE_DEFAULTS = {
+    'current_plan': None,
+    'current_plan_index': 0,
+    'mission_in_progress': False,
+    'pending_orders': (),
+    'max_capacity': 3,
+    'last_mission_start_time': None,
+    'mission_timeout': 30
+}
 
 # State cache
 knowledge = None
 environment = None
-previous_obstacles = set()
+static_cells = 0
+dynamic_cells = 0
+blocked_cells = 0
+plan_cells = None
+plan_suffixes = []
+previous_obstacles = 0
+loaded_locations = frozenset()
+sensor_fragment = ''
 client = None
+inbox = queue.Queue()
+
+# Result dict reused every cycle; it is serialized before the handler returns.
+# sensor_data is spliced in from sensor_fragment, which only changes with the environment.
+results = {
+    'needs_new_mission': None,
+    'path_blocked': None,
+    'obstacle_removed': None,
+    'at_delivery_location': None,
+    'at_base': None
+}
+
+
+class KnowledgeCache:
+    # Slot attributes instead of dict lookups on every tick; the wire format is unchanged
+    __slots__ = tuple(KNOWLEDGE_DEFAULTS)
+    
+    def __init__(self, snapshot):
+        for key, default in KNOWLEDGE_DEFAULTS.items():
+            setattr(self, key, snapshot.get(key, default))
+    
+    def update(self, delta):
+        for key in KNOWLEDGE_DEFAULTS.keys() & delta.keys():
+            setattr(self, key, delta[key])
+
+
+def cell_bits(cells, width):
+    bits = 0
+    for r, c in cells:
+        bits |= 1 << (r * width + c)
+    return bits
+
+
+def build_static_cells(grid):
+    # One bit per cell (row-major), set for static obstacles
+    width = grid.get('width', 0)
+    bits = 0
+    for r, row in enumerate(grid.get('grid', [])):
+        for c, cell in enumerate(row):
+            if cell == OBSTACLE:
+                bits |= 1 << (r * width + c)
+    return bits
+
+
+def build_plan_suffixes(plan, width):
+    # suffixes[i] holds the cell bits of plan[i:]
+    suffixes = [0] * len(plan)
+    bits = 0
+    for i in range(len(plan) - 1, -1, -1):
+        r, c = plan[i]
+        bits |= 1 << (r * width + c)
+        suffixes[i] = bits
+    return suffixes
+
+
+def merge_environment_delta(environment, delta):
+    # Deltas replace whole runtime sections; the static grid only arrives in snapshots
+    if 'robot' in delta:
+        environment['robot'] = delta['robot']
+    if 'dynamic_obstacles' in delta:
+        environment.setdefault('grid', {})['dynamic_obstacles'] = delta['dynamic_obstacles']
+
+
+def derive_environment(environment):
+    # Dynamic obstacle bits are computed here, where they change, not per monitor tick
+    grid = environment.get('grid', {})
+    dynamic = cell_bits(grid.get('dynamic_obstacles', []), grid.get('width', 0))
+    loaded = frozenset(
+        tuple(o['delivery_location'])
+        for o in environment.get('robot', {}).get('loaded_orders', [])
+    )
+    return dynamic, loaded
+
+
+def encode_sensor_fragment(environment):
+    # Environment-derived sensor_data members as JSON, without braces
+    robot = environment.get('robot', {})
+    return encode({
+        'robot_position': robot.get('position', [1, 1]),
+        'loaded_orders': robot.get('loaded_orders', []),
+        'is_at_base': robot.get('is_at_base', True),
+        'dynamic_obstacles': environment.get('grid', {}).get('dynamic_obstacles', [])
+    })[1:-1]
 
 
 def handle_message(client_obj, userdata, msg):
-    global knowledge, environment, previous_obstacles
+    global knowledge, environment, static_cells, dynamic_cells, blocked_cells
+    global plan_cells, plan_suffixes, previous_obstacles, loaded_locations, sensor_fragment
     
     try:
         topic = msg.topic
-        payload = json.loads(msg.payload.decode('utf-8')) if msg.payload else {}
+        payload = json.loads(msg.payload) if msg.payload else {}
+        
+        if topic == KNOWLEDGE_UPDATE:
+            knowledge = KnowledgeCache(payload)
         
-        if topic == TOPICS['knowledge_update']:
-            knowledge = payload
+        elif topic == KNOWLEDGE_DELTA:
+            if knowledge:
+                knowledge.update(payload)
         
-        elif topic == TOPICS['environment_update']:
+        elif topic == ENVIRONMENT_UPDATE:
             environment = payload
+            static_cells = build_static_cells(environment.get('grid', {}))
+            dynamic_cells, loaded_locations = derive_environment(environment)
+            blocked_cells = static_cells | dynamic_cells
+            sensor_fragment = encode_sensor_fragment(environment)
         
-        elif topic == TOPICS['system_reset']:
-            previous_obstacles = set()
+        elif topic == ENVIRONMENT_DELTA:
+            if not environment:
+                return
+            merge_environment_delta(environment, payload)
+            dynamic_cells, loaded_locations = derive_environment(environment)
+            blocked_cells = static_cells | dynamic_cells
+            sensor_fragment = encode_sensor_fragment(environment)
+        
+        elif topic == SYSTEM_RESET:
+            previous_obstacles = 0
             knowledge = None
             environment = None
+            static_cells = 0
+            dynamic_cells = 0
+            blocked_cells = 0
+            plan_cells = None
+            plan_suffixes = []
+            loaded_locations = frozenset()
+            sensor_fragment = ''
         
-        elif topic == TOPICS['monitor_request']:
+        elif topic == MONITOR_REQUEST:
             if not knowledge or not environment:
                 print("[Monitor] State not ready")
                 return
@@ -49,83 +188,90 @@ def handle_message(client_obj, userdata, msg):
             robot = environment.get('robot', {})
             
             robot_position = robot.get('position', [1, 1])
-            loaded_orders = robot.get('loaded_orders', [])
             is_at_base = robot.get('is_at_base', True)
-            dynamic_obstacles = grid.get('dynamic_obstacles', [])
+            width = grid.get('width', 0)
             
             # Check obstacle changes
-            current_obstacles = set(tuple(o) for o in dynamic_obstacles)
-            obstacle_removed = len(previous_obstacles - current_obstacles) > 0
-            previous_obstacles = current_obstacles
+            obstacle_removed = bool(previous_obstacles & ~dynamic_cells)
+            previous_obstacles = dynamic_cells
             
             # Check path blocked
             path_blocked = False
-            current_plan = knowledge.get('current_plan')
-            plan_index = knowledge.get('current_plan_index', 0)
+            current_plan = knowledge.current_plan
+            plan_index = knowledge.current_plan_index
             
             if current_plan:
-                for i in range(plan_index, len(current_plan)):
-                    pos = current_plan[i]
-                    grid_data = grid.get('grid', [])
-                    if grid_data and grid_data[pos[0]][pos[1]] == 1:
-                        path_blocked = True
-                        break
-                    if pos in dynamic_obstacles:
-                        path_blocked = True
-                        break
+                if current_plan != plan_cells:
+                    plan_cells = current_plan
+                    plan_suffixes = build_plan_suffixes(current_plan, width)
+                if plan_index < len(plan_suffixes):
+                    path_blocked = bool(blocked_cells & plan_suffixes[plan_index])
             
             # Check at delivery location
-            at_delivery_location = False
-            for order in loaded_orders:
-                if order['delivery_location'] == robot_position:
-                    at_delivery_location = True
-                    break
+            at_delivery_location = tuple(robot_position) in loaded_locations
             
             # Check mission start conditions
             needs_new_mission = False
-            mission_in_progress = knowledge.get('mission_in_progress', False)
-            pending_orders = knowledge.get('pending_orders', [])
-            max_capacity = knowledge.get('max_capacity', 3)
+            mission_in_progress = knowledge.mission_in_progress
+            pending_orders = knowledge.pending_orders
             
             if not mission_in_progress:
-                if len(pending_orders) >= max_capacity:
+                if len(pending_orders) >= knowledge.max_capacity:
                     needs_new_mission = True
                 elif pending_orders:
-                    elapsed = time.time() - knowledge.get('last_mission_start_time', time.time())
-                    if elapsed >= knowledge.get('mission_timeout', 30):
+                    now = time.time()
+                    last_start = knowledge.last_mission_start_time
+                    elapsed = now - (now if last_start is None else last_start)
+                    if elapsed >= knowledge.mission_timeout:
                         needs_new_mission = True
             
             # Publish results
-            results = {
-                'sensor_data': {
-                    'robot_position': robot_position,
-                    'loaded_orders': loaded_orders,
-                    'is_at_base': is_at_base,
-                    'dynamic_obstacles': dynamic_obstacles,
-                    'mission_in_progress': mission_in_progress
-                },
-                'needs_new_mission': needs_new_mission,
-                'path_blocked': path_blocked,
-                'obstacle_removed': obstacle_removed,
-                'at_delivery_location': at_delivery_location,
-                'at_base': is_at_base,
-                'knowledge': knowledge,
-                'grid': grid
-            }
+            results['needs_new_mission'] = needs_new_mission
+            results['path_blocked'] = path_blocked
+            results['obstacle_removed'] = obstacle_removed
+            results['at_delivery_location'] = at_delivery_location
+            results['at_base'] = is_at_base
             
-            client.publish(TOPICS['monitor_result'], json.dumps(results))
+            client.publish(MONITOR_RESULT, '{"sensor_data":{%s,"mission_in_progress":%s},%s}' % (
+                sensor_fragment,
+                encode(mission_in_progress),
+                encode(results)[1:-1]
+            ))
             print(f"[Monitor] Published: needs_mission={needs_new_mission}, blocked={path_blocked}")
     
     except Exception as e:
         print(f"[Monitor] Error: {e}")
 
 
+def enqueue_message(client_obj, userdata, msg):
+    # Decoding and publishing happen in process_loop, off the network thread
+    inbox.put(msg)
+
+
+def process_loop():
+    while True:
+        handle_message(client, None, inbox.get())
+
+
+def on_socket_open(client_obj, userdata, sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def on_connect_fail(client_obj, userdata):
+    print("[Monitor] Waiting for MQTT...")
+
+
 def on_connect(client_obj, userdata, flags, rc):
     print("[Monitor] Connected to MQTT")
-    client_obj.subscribe(TOPICS['knowledge_update'])
-    client_obj.subscribe(TOPICS['environment_update'])
-    client_obj.subscribe(TOPICS['monitor_request'])
-    client_obj.subscribe(TOPICS['system_reset'])
+    client_obj.subscribe([
+        (KNOWLEDGE_UPDATE, 0),
+        (KNOWLEDGE_DELTA, 0),
+        (ENVIRONMENT_UPDATE, 0),
+        (ENVIRONMENT_DELTA, 0),
+        (MONITOR_REQUEST, 0),
+        (SYSTEM_RESET, 0)
+    ])
+    client_obj.publish(SYSTEM_SYNC, encode({}))
 
 
 if __name__ == '__main__':
@@ -133,15 +279,13 @@ if __name__ == '__main__':
     
     client = mqtt.Client(client_id=f"monitor-{uuid.uuid4().hex[:8]}")
     client.on_connect = on_connect
-    client.on_message = handle_message
+    client.on_socket_open = on_socket_open
+    client.on_connect_fail = on_connect_fail
+    client.on_message = enqueue_message
     
-    while True:
-        try:
-            client.connect(BROKER, PORT, 60)
-            break
-        except:
-            print("[Monitor] Waiting for MQTT...")
-            time.sleep(2)
+    client.reconnect_delay_set(min_delay=1, max_delay=30)
+    client.connect_async(BROKER, PORT, 60)
     
     print("[Monitor] Ready")
-    client.loop_forever()
\ No newline at end of file
+    client.loop_start()
+    process_loop()
\ No newline at end of file
@@ -3,11 +3,10 @@ Plan Service - Creates plans using A* pathfinding.
 """
 import paho.mqtt.client as mqtt
 import json
-import time
 import uuid
 import os
+import socket
 import heapq
-from itertools import permutations
 
 # Load config
 with open('/app/config.json') as f:
@@ -16,10 +15,38 @@ with open('/app/config.json') as f:
 BROKER = os.environ.get('MQTT_BROKER', CONFIG['mqtt']['broker'])
 PORT = CONFIG['mqtt']['port']
 TOPICS = CONFIG['topics']
+KNOWLEDGE_UPDATE = TOPICS['knowledge_update']
+KNOWLEDGE_DELTA = TOPICS['knowledge_delta']
+ENVIRONMENT_UPDATE = TOPICS['environment_update']
+ENVIRONMENT_DELTA = TOPICS['environment_delta']
+ANALYZE_RESULT = TOPICS['analyze_result']
+PLAN_RESULT = TOPICS['plan_result']
+SYSTEM_SYNC = TOPICS['system_sync']
+
+encode = json.JSONEncoder(separators=(',', ':')).encode
 
 OBSTACLE = 1
+
+# Prebuilt continue action; Execute recognises these exact bytes without parsing them
+CONTINUE = b'{"action":"continue"}'
+
+# Held-Karp is O(n^2 * 2^n); above this many stops nearest-neighbor is used
+MAX_OPTIMAL_DELIVERIES = 10
+
+# Distance of unreachable pairs; an int so route costs never mix in floats.
+# Any sum involving it stays >= UNREACHABLE, far above any real route on the grid.
+UNREACHABLE = 1 << 30
+
+# State cache
+knowledge = None
+grid = None
 client = None
 
+# A* results keyed by (start, goal) and BFS distance maps keyed by source;
+# both are only valid for the current obstacle layout
+path_cache = {}
+distance_cache = {}
+
 
 # ========== A* PATHFINDING ==========
 
@@ -27,57 +54,189 @@ def heuristic(a, b):
     return abs(a[0] - b[0]) + abs(a[1] - b[1])
 
 
-def get_neighbors(grid, pos):
-    row, col = pos
-    height = len(grid['grid'])
-    width = len(grid['grid'][0])
+def build_passable(grid):
+    # Row-major flat cells: 1 if the robot may enter, 0 for static/dynamic obstacles.
+    # A one-cell wall border means neighbor lookups never need bounds checks;
+    # cell (r, c) lives at (r + 1) * stride + c + 1 with stride = width + 2.
+    stride = grid['width'] + 2
+    passable = bytearray(stride)
+    for row in grid['grid']:
+        passable.append(0)
+        passable.extend(cell != OBSTACLE for cell in row)
+        passable.append(0)
+    passable.extend(bytes(stride))
+    for r, c in grid.get('dynamic_obstacles', []):
+        passable[(r + 1) * stride + c + 1] = 0
+    return passable
+
+
+def build_components(grid):
+    # Connected-component label per padded cell (0 for walls), so searches between
+    # components can be rejected without exploring one of them entirely
+    passable = grid['passable']
+    stride = grid['width'] + 2
+    steps = (-stride, stride, -1, 1)
+    components = [0] * len(passable)
+    label = 0
+    for seed, open_cell in enumerate(passable):
+        if not open_cell or components[seed]:
+            continue
+        label += 1
+        components[seed] = label
+        stack = [seed]
+        while stack:
+            i = stack.pop()
+            for step in steps:
+                j = i + step
+                if passable[j] and not components[j]:
+                    components[j] = label
+                    stack.append(j)
+    return components
+
+
+def is_passable(grid, pos):
+    r, c = pos
+    if not (0 <= r < grid['height'] and 0 <= c < grid['width']):
+        return False
+    return grid['passable'][(r + 1) * (grid['width'] + 2) + c + 1]
+
+
+def invalidate_caches(grid, previous):
+    # Drop only the cached results a dynamic obstacle change can affect
+    passable = grid['passable']
+    closed = [i for i, (was, now) in enumerate(zip(previous, passable)) if was and not now]
+    if len(closed) != previous.count(1) - passable.count(1):
+        # A cell opened up, which can shorten any route or reconnect unreachable pairs
+        path_cache.clear()
+        distance_cache.clear()
+        return
+    if not closed:
+        return
     
-    for dr, dc in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
-        r, c = row + dr, col + dc
-        if 0 <= r < height and 0 <= c < width:
-            if grid['grid'][r][c] != OBSTACLE:
-                if [r, c] not in grid.get('dynamic_obstacles', []):
-                    yield (r, c)
+    # Closing cells only lengthens routes: a path that avoids them stays shortest,
+    # and unreachable pairs stay unreachable
+    stride = grid['width'] + 2
+    for key, path in list(path_cache.items()):
+        if path and not all(passable[(r + 1) * stride + c + 1] for r, c in path[1:]):
+            del path_cache[key]
+    for source, dist in list(distance_cache.items()):
+        if any(dist[i] >= 0 for i in closed):
+            del distance_cache[source]
 
 
 def find_path(grid, start, goal):
-    start = tuple(start)
-    goal = tuple(goal)
-    
+    # Distance matrices and full-path construction ask for the same legs repeatedly
+    key = (tuple(start), tuple(goal))
+    if key not in path_cache:
+        path_cache[key] = search_path(grid, key[0], key[1])
+    return path_cache[key]
+
+
+def search_path(grid, start, goal):
     if start == goal:
         return [list(start)]
     
-    if grid['grid'][goal[0]][goal[1]] == OBSTACLE:
+    if not is_passable(grid, goal):
         return None
-    if list(goal) in grid.get('dynamic_obstacles', []):
+    
+    # Nodes are plain ints indexing the padded mask, so bookkeeping is flat lists
+    # instead of tuple-keyed dicts and sets
+    passable = grid['passable']
+    stride = grid['width'] + 2
+    steps = (-stride, stride, -1, 1)
+    size = len(passable)
+    start_index = (start[0] + 1) * stride + start[1] + 1
+    goal_row, goal_col = goal[0] + 1, goal[1] + 1
+    goal_index = goal_row * stride + goal_col
+    
+    # A start on a blocked cell has no label of its own but may still step out
+    components = grid['components']
+    if components[start_index] and components[start_index] != components[goal_index]:
         return None
     
-    counter = 0
-    frontier = [(0, counter, start, [start])]
-    visited = set()
+    g_score = [-1] * size
+    came_from = [-1] * size
+    visited = bytearray(size)
     
-    while frontier:
-        _, _, current, path = heapq.heappop(frontier)
-        if current in visited:
+    # Heap entries are (f, h, node): ties on f go to the node nearer the goal.
+    # They carry no path; it is rebuilt from came_from at the goal.
+    # The last neighbor pushed is held back and fused with the next pop through
+    # heappushpop, which skips the sift whenever it is already the best entry
+    h = heuristic(start, goal)
+    frontier = []
+    pending = (h, h, start_index)
+    g_score[start_index] = 0
+    
+    while pending or frontier:
+        if pending:
+            current = heapq.heappushpop(frontier, pending)[2]
+            pending = None
+        else:
+            current = heapq.heappop(frontier)[2]
+        if visited[current]:
             continue
-        visited.add(current)
+        visited[current] = 1
         
-        if current == goal:
-            return [list(p) for p in path]
+        if current == goal_index:
+            # The path length is known from g, so it is filled back to front in place
+            path = [None] * (g_score[current] + 1)
+            for i in range(len(path) - 1, -1, -1):
+                r, c = divmod(current, stride)
+                path[i] = [r - 1, c - 1]
+                current = came_from[current]
+            return path
         
-        for neighbor in get_neighbors(grid, current):
-            if neighbor not in visited:
-                new_path = path + [neighbor]
-                counter += 1
-                f = len(new_path) - 1 + heuristic(neighbor, goal)
-                heapq.heappush(frontier, (f, counter, neighbor, new_path))
+        g = g_score[current] + 1
+        for step in steps:
+            neighbor = current + step
+            if passable[neighbor] and (g_score[neighbor] < 0 or g < g_score[neighbor]):
+                g_score[neighbor] = g
+                came_from[neighbor] = current
+                r, c = divmod(neighbor, stride)
+                h = abs(r - goal_row) + abs(c - goal_col)
+                if pending:
+                    heapq.heappush(frontier, pending)
+                pending = (g + h, h, neighbor)
     
     return None
 
 
-def calc_distance(grid, p1, p2):
-    path = find_path(grid, p1, p2)
-    return len(path) - 1 if path else float('inf')
+def bfs_distances(grid, source):
+    # Moves all cost 1, so one BFS gives the distance from source to every cell
+    # (indexed like the padded passability mask, -1 where unreachable)
+    source = tuple(source)
+    if source in distance_cache:
+        return distance_cache[source]
+    
+    passable = grid['passable']
+    stride = grid['width'] + 2
+    steps = (-stride, stride, -1, 1)
+    dist = [-1] * len(passable)
+    start = (source[0] + 1) * stride + source[1] + 1
+    dist[start] = 0
+    frontier = [start]
+    d = 0
+    while frontier:
+        d += 1
+        next_frontier = []
+        for i in frontier:
+            for step in steps:
+                j = i + step
+                if passable[j] and dist[j] < 0:
+                    dist[j] = d
+                    next_frontier.append(j)
+        frontier = next_frontier
+    
+    distance_cache[source] = dist
+    return dist
+
+
+def distance_to(grid, dist, pos):
+    r, c = pos
+    if not (0 <= r < grid['height'] and 0 <= c < grid['width']):
+        return UNREACHABLE
+    d = dist[(r + 1) * (grid['width'] + 2) + c + 1]
+    return UNREACHABLE if d < 0 else d
 
 
 def plan_sequence(grid, start, deliveries, base):
@@ -86,56 +245,83 @@ def plan_sequence(grid, start, deliveries, base):
     if len(deliveries) == 1:
         return [deliveries[0]]
     
-    if len(deliveries) <= 5:
+    if len(deliveries) <= MAX_OPTIMAL_DELIVERIES:
         return optimal_sequence(grid, start, deliveries, base)
     return nearest_neighbor(grid, start, deliveries)
 
 
 def optimal_sequence(grid, start, deliveries, base):
-    start = tuple(start)
-    base = tuple(base)
-    locs = [tuple(d) for d in deliveries]
-    
-    best_seq, best_dist = None, float('inf')
-    
-    for perm in permutations(locs):
-        dist, current = 0, start
-        valid = True
-        for loc in perm:
-            d = calc_distance(grid, current, loc)
-            if d == float('inf'):
-                valid = False
-                break
-            dist += d
-            current = loc
-        if valid:
-            d = calc_distance(grid, current, base)
-            if d != float('inf'):
-                dist += d
-                if dist < best_dist:
-                    best_dist, best_seq = dist, list(perm)
-    
-    if best_seq:
-        return [list(p) for p in best_seq]
-    return nearest_neighbor(grid, start, deliveries)
+    # Held-Karp: best[mask][i] is the shortest route from start through the
+    # deliveries in mask, ending at delivery i
+    n = len(deliveries)
+    points = [tuple(start)] + [tuple(d) for d in deliveries] + [tuple(base)]
+    # One BFS per leg origin fills its whole row; base is only ever a destination
+    dist = [
+        [distance_to(grid, row, p) for p in points]
+        for row in (bfs_distances(grid, a) for a in points[:-1])
+    ]
+    
+    full = (1 << n) - 1
+    best = [[UNREACHABLE] * n for _ in range(full + 1)]
+    parent = [[-1] * n for _ in range(full + 1)]
+    for i in range(n):
+        best[1 << i][i] = dist[0][i + 1]
+    
+    # Every successor mask is numerically larger, so ascending order is a valid DP order
+    for mask in range(1, full + 1):
+        row = best[mask]
+        for i in range(n):
+            d = row[i]
+            if d >= UNREACHABLE or not (mask >> i) & 1:
+                continue
+            from_i = dist[i + 1]
+            for j in range(n):
+                if (mask >> j) & 1:
+                    continue
+                nd = d + from_i[j + 1]
+                next_mask = mask | (1 << j)
+                if nd < best[next_mask][j]:
+                    best[next_mask][j] = nd
+                    parent[next_mask][j] = i
+    
+    last, best_dist = -1, UNREACHABLE
+    for i in range(n):
+        d = best[full][i] + dist[i + 1][n + 1]
+        if d < best_dist:
+            last, best_dist = i, d
+    
+    if last == -1:
+        return nearest_neighbor(grid, start, deliveries)
+    
+    sequence = []
+    mask = full
+    while last != -1:
+        sequence.append(list(points[last + 1]))
+        mask, last = mask & ~(1 << last), parent[mask][last]
+    sequence.reverse()
+    return sequence
 
 
 def nearest_neighbor(grid, start, deliveries):
     seq = []
-    remaining = [list(d) for d in deliveries]
+    remaining = list(range(len(deliveries)))
     current = list(start)
     
     while remaining:
-        nearest, min_d = None, float('inf')
-        for loc in remaining:
-            d = calc_distance(grid, current, loc)
-            if d < min_d:
-                min_d, nearest = d, loc
-        if not nearest:
+        # One BFS from the current stop ranks every remaining stop
+        dist = bfs_distances(grid, current)
+        nearest, min_d = -1, UNREACHABLE
+        for i, k in enumerate(remaining):
+            d = distance_to(grid, dist, deliveries[k])
+            # Ties go to the earliest delivery, so swap-pop reordering cannot change the result
+            if d < min_d or (d == min_d and nearest >= 0 and k < remaining[nearest]):
+                min_d, nearest = d, i
+        if nearest < 0:
             break
-        seq.append(nearest)
-        remaining.remove(nearest)
-        current = nearest
+        current = list(deliveries[remaining[nearest]])
+        remaining[nearest] = remaining[-1]
+        remaining.pop()
+        seq.append(current)
     
     return seq
 
@@ -160,33 +346,54 @@ def create_full_path(grid, start, sequence, base):
 
 
 def handle_message(client_obj, userdata, msg):
-    global client
+    global knowledge, grid, client
     
     try:
         topic = msg.topic
-        payload = json.loads(msg.payload.decode('utf-8')) if msg.payload else {}
+        payload = json.loads(msg.payload) if msg.payload else {}
+        
+        if topic == KNOWLEDGE_UPDATE:
+            knowledge = payload
+        
+        elif topic == KNOWLEDGE_DELTA:
+            if knowledge:
+                knowledge.update(payload)
         
-        if topic == TOPICS['analyze_result']:
+        elif topic == ENVIRONMENT_UPDATE:
+            grid = payload.get('grid', {})
+            grid['passable'] = build_passable(grid)
+            grid['components'] = build_components(grid)
+            path_cache.clear()
+            distance_cache.clear()
+        
+        elif topic == ENVIRONMENT_DELTA:
+            # Only dynamic obstacles affect planning; robot state comes from knowledge
+            if grid and 'dynamic_obstacles' in payload:
+                previous = grid['passable']
+                grid['dynamic_obstacles'] = payload['dynamic_obstacles']
+                grid['passable'] = build_passable(grid)
+                grid['components'] = build_components(grid)
+                invalidate_caches(grid, previous)
+        
+        elif topic == ANALYZE_RESULT:
             if not payload.get('requires_adaptation'):
-                client.publish(TOPICS['plan_result'], json.dumps({'action': 'continue'}))
+                client.publish(PLAN_RESULT, CONTINUE)
                 print("[Plan] No adaptation needed")
                 return
             
             action = payload.get('adaptation_type')
-            knowledge = payload.get('knowledge', {})
-            grid = payload.get('grid', {})
             
             if action == 'start_mission':
-                plan_start_mission(knowledge, grid)
+                plan_start_mission(knowledge or {}, grid or {})
             elif action == 'replan':
-                plan_replan(knowledge, grid)
+                plan_replan(knowledge or {}, grid or {})
             elif action == 'deliver':
-                plan_deliver(knowledge)
+                plan_deliver(knowledge or {})
             elif action == 'end_mission':
-                client.publish(TOPICS['plan_result'], json.dumps({'action': 'end_mission'}))
+                client.publish(PLAN_RESULT, encode({'action': 'end_mission'}))
                 print("[Plan] End mission")
             else:
-                client.publish(TOPICS['plan_result'], json.dumps({'action': 'continue'}))
+                client.publish(PLAN_RESULT, CONTINUE)
     
     except Exception as e:
         print(f"[Plan] Error: {e}")
@@ -197,7 +404,7 @@ def plan_start_mission(knowledge, grid):
     
     orders = knowledge.get('pending_orders', [])[:knowledge.get('max_capacity', 3)]
     if not orders or not grid:
-        client.publish(TOPICS['plan_result'], json.dumps({'action': 'continue'}))
+        client.publish(PLAN_RESULT, CONTINUE)
         return
     
     base = knowledge.get('base_location', [1, 1])
@@ -207,10 +414,10 @@ def plan_start_mission(knowledge, grid):
     path = create_full_path(grid, base, sequence, base)
     
     if not path:
-        client.publish(TOPICS['plan_result'], json.dumps({'action': 'continue'}))
+        client.publish(PLAN_RESULT, CONTINUE)
         return
     
-    client.publish(TOPICS['plan_result'], json.dumps({
+    client.publish(PLAN_RESULT, encode({
         'action': 'start_mission',
         'orders': orders,
         'sequence': sequence,
@@ -235,11 +442,11 @@ def plan_replan(knowledge, grid):
         path = create_full_path(grid, pos, sequence, base)
     
     if not path:
-        client.publish(TOPICS['plan_result'], json.dumps({'action': 'wait', 'reason': 'no_path'}))
+        client.publish(PLAN_RESULT, encode({'action': 'wait', 'reason': 'no_path'}))
         print("[Plan] No path - wait")
         return
     
-    client.publish(TOPICS['plan_result'], json.dumps({
+    client.publish(PLAN_RESULT, encode({
         'action': 'replan',
         'path': path,
         'sequence': sequence
@@ -253,19 +460,34 @@ def plan_deliver(knowledge):
     pos = knowledge.get('robot_position')
     for order in knowledge.get('loaded_orders', []):
         if order['delivery_location'] == pos:
-            client.publish(TOPICS['plan_result'], json.dumps({
+            client.publish(PLAN_RESULT, encode({
                 'action': 'deliver',
                 'order': order
             }))
             print(f"[Plan] Deliver {order['order_id']}")
             return
     
-    client.publish(TOPICS['plan_result'], json.dumps({'action': 'continue'}))
+    client.publish(PLAN_RESULT, CONTINUE)
+
+
+def on_socket_open(client_obj, userdata, sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def on_connect_fail(client_obj, userdata):
+    print("[Plan] Waiting for MQTT...")
 
 
 def on_connect(client_obj, userdata, flags, rc):
     print("[Plan] Connected to MQTT")
-    client_obj.subscribe(TOPICS['analyze_result'])
+    client_obj.subscribe([
+        (KNOWLEDGE_UPDATE, 0),
+        (KNOWLEDGE_DELTA, 0),
+        (ENVIRONMENT_UPDATE, 0),
+        (ENVIRONMENT_DELTA, 0),
+        (ANALYZE_RESULT, 0)
+    ])
+    client_obj.publish(SYSTEM_SYNC, encode({}))
 
 
 if __name__ == '__main__':
@@ -273,15 +495,12 @@ if __name__ == '__main__':
     
     client = mqtt.Client(client_id=f"plan-{uuid.uuid4().hex[:8]}")
     client.on_connect = on_connect
+    client.on_socket_open = on_socket_open
+    client.on_connect_fail = on_connect_fail
     client.on_message = handle_message
     
-    while True:
-        try:
-            client.connect(BROKER, PORT, 60)
-            break
-        except:
-            print("[Plan] Waiting for MQTT...")
-            time.sleep(2)
+    client.reconnect_delay_set(min_delay=1, max_delay=30)
+    client.connect_async(BROKER, PORT, 60)
     
     print("[Plan] Ready")
-    client.loop_forever()
\ No newline at end of file
+    client.loop_forever(retry_first_connection=True)
\ No newline at end of file
@@ -2,14 +2,22 @@
 Web Service - UI and MAPE-K loop trigger.
 """
 from flask import Flask, render_template, send_from_directory
-from flask_socketio import SocketIO
+from flask_socketio import SocketIO, emit
 import paho.mqtt.client as mqtt
 import json
+import math
 import time
 import os
+import socket
+import threading
 
-import eventlet
-eventlet.monkey_patch()
+# Socket.IO server backend: eventlet (default) or threading
+ASYNC_MODE = os.environ.get('SOCKETIO_ASYNC_MODE', 'eventlet')
+if ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+elif ASYNC_MODE != 'threading':
+    raise Exception(f"Unsupported SOCKETIO_ASYNC_MODE: {ASYNC_MODE}")
 
 # Load config
 with open('/app/config.json') as f:
@@ -18,105 +26,263 @@ with open('/app/config.json') as f:
 BROKER = os.environ.get('MQTT_BROKER', CONFIG['mqtt']['broker'])
 PORT = CONFIG['mqtt']['port']
 TOPICS = CONFIG['topics']
+SYSTEM_INIT = TOPICS['system_init']
+SYSTEM_INIT_ACK = TOPICS['system_init_ack']
+SYSTEM_RESET = TOPICS['system_reset']
+SYSTEM_SYNC = TOPICS['system_sync']
+MONITOR_REQUEST = TOPICS['monitor_request']
+USER_ADD_ORDER = TOPICS['user_add_order']
+USER_TOGGLE_OBSTACLE = TOPICS['user_toggle_obstacle']
+KNOWLEDGE_UPDATE = TOPICS['knowledge_update']
+KNOWLEDGE_DELTA = TOPICS['knowledge_delta']
+ENVIRONMENT_UPDATE = TOPICS['environment_update']
+ENVIRONMENT_DELTA = TOPICS['environment_delta']
+
+# Seconds to wait for the first broker connection before giving up
+MQTT_CONNECT_TIMEOUT = 90
+
+# Seconds to wait for Knowledge and Environment to acknowledge system/init
+INIT_TIMEOUT = 2.0
+INIT_SERVICES = frozenset(('knowledge', 'environment'))
+
+# Bursts of state messages (knowledge + environment per MAPE step) become one emit
+EMIT_INTERVAL = 0.1
+
+# Compact encoder for MQTT payloads and for comparing successive states
+encode = json.JSONEncoder(separators=(',', ':')).encode
+
+# Body of the parameterless requests (init, reset, sync, monitor tick)
+EMPTY_JSON = b'{}'
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret'
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet')
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=ASYNC_MODE)
+
+# The page has no template variables, so it is rendered once and served as-is
+with app.app_context():
+    INDEX_HTML = render_template('index.html')
 
 mqtt_client = None
+mqtt_ready = False
+client_count = 0
+init_acks = set()
+init_done = threading.Event()
 running = False
 order_counter = 0
 current_knowledge = None
 current_environment = None
+state_dirty = False
+last_fields = {}
+static_dirty = False
+delivery_set = frozenset()
+
+# Frame reused for every emit. Static fields are filled from environment snapshots;
+# build_state overwrites the rest in place.
+STATIC_FIELDS = ('grid', 'width', 'height', 'base_location', 'delivery_locations')
+frame = {
+    'grid': '',
+    'width': 22,
+    'height': 15,
+    'base_location': [1, 1],
+    'delivery_locations': [],
+    'robot_position': [1, 1],
+    'dynamic_obstacles': [],
+    'pending_locations': [],
+    'delivery_sequence': {},
+    'last_delivery_location': None,
+    'current_path': [],
+    'current_path_index': 0,
+    'loaded_orders': 0,
+    'pending_count': 0,
+    'is_stuck': False,
+    'countdown': None,
+    'mission_in_progress': False,
+    'metrics': {
+        'total_deliveries': 0,
+        'total_distance': 0,
+        'replans': 0,
+        'avg_delivery_time': 0
+    }
+}
+DYNAMIC_FIELDS = tuple(key for key in frame if key not in STATIC_FIELDS)
+
+# Last (topic, payload) applied per state stream. Snapshots and deltas both replace
+# whole fields, so the same message twice in a row leaves the state unchanged.
+STATE_STREAMS = {
+    KNOWLEDGE_UPDATE: 'knowledge',
+    KNOWLEDGE_DELTA: 'knowledge',
+    ENVIRONMENT_UPDATE: 'environment',
+    ENVIRONMENT_DELTA: 'environment'
+}
+last_applied = {}
+
+# delivery_sequence rendered as {"row,col": stop number}; rebuilt only when it changes
+seq_source = None
+seq_map = {}
+
+
+def on_socket_open(client_obj, userdata, sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def on_mqtt_connect_fail(client, userdata):
+    print("[Web] Waiting for MQTT...")
 
 
 def on_mqtt_connect(client, userdata, flags, rc):
+    global mqtt_ready
+    
     print("[Web] Connected to MQTT")
-    client.subscribe(TOPICS['knowledge_update'])
-    client.subscribe(TOPICS['environment_update'])
+    client.subscribe([
+        (KNOWLEDGE_UPDATE, 0),
+        (KNOWLEDGE_DELTA, 0),
+        (ENVIRONMENT_UPDATE, 0),
+        (ENVIRONMENT_DELTA, 0),
+        (SYSTEM_INIT_ACK, 0)
+    ])
+    client.publish(SYSTEM_SYNC, EMPTY_JSON)
+    mqtt_ready = True
+
+
+def encode_grid_cells(grid):
+    # Cell kinds are single digits, so the static grid ships as one row-major string
+    return ''.join(str(cell) for row in grid.get('grid', []) for cell in row)
+
+
+def set_static_fields(grid):
+    global static_dirty
+    
+    frame['grid'] = encode_grid_cells(grid)
+    frame['width'] = grid.get('width', 22)
+    frame['height'] = grid.get('height', 15)
+    frame['base_location'] = grid.get('base_location', [1, 1])
+    frame['delivery_locations'] = grid.get('delivery_locations', [])
+    static_dirty = True
 
 
 def on_mqtt_message(client, userdata, msg):
-    global current_knowledge, current_environment
+    global current_knowledge, current_environment, state_dirty, delivery_set
     
     try:
-        payload = json.loads(msg.payload.decode('utf-8'))
+        topic = msg.topic
+        if topic == SYSTEM_INIT_ACK:
+            init_acks.add(json.loads(msg.payload).get('service'))
+            if INIT_SERVICES <= init_acks:
+                init_done.set()
+            return
         
-        if msg.topic == TOPICS['knowledge_update']:
+        stream = STATE_STREAMS.get(topic)
+        applied = (topic, msg.payload)
+        if last_applied.get(stream) == applied:
+            return
+        
+        payload = json.loads(msg.payload)
+        
+        if topic == KNOWLEDGE_UPDATE:
             current_knowledge = payload
-            socketio.start_background_task(broadcast_state)
-        elif msg.topic == TOPICS['environment_update']:
+            state_dirty = True
+        elif topic == KNOWLEDGE_DELTA:
+            if not current_knowledge:
+                return
+            current_knowledge.update(payload)
+            state_dirty = True
+        elif topic == ENVIRONMENT_UPDATE:
             current_environment = payload
-            socketio.start_background_task(broadcast_state)
+            set_static_fields(payload.get('grid', {}))
+            delivery_set = frozenset(tuple(loc) for loc in payload.get('grid', {}).get('delivery_locations', []))
+            state_dirty = True
+        elif topic == ENVIRONMENT_DELTA:
+            if not current_environment:
+                return
+            if 'robot' in payload:
+                current_environment['robot'] = payload['robot']
+            if 'dynamic_obstacles' in payload:
+                current_environment['grid']['dynamic_obstacles'] = payload['dynamic_obstacles']
+            state_dirty = True
+        
+        last_applied[stream] = applied
     except Exception as e:
         print(f"[Web] Error: {e}")
 
 
-def broadcast_state():
-    global current_knowledge, current_environment
+def build_seq_map(sequence):
+    return {f"{r},{c}": i for i, (r, c) in enumerate(sequence, 1)}
+
+
+def build_state():
+    global current_knowledge, current_environment, seq_source, seq_map
     
     if not current_knowledge or not current_environment:
-        return
+        return None
     
     grid = current_environment.get('grid', {})
     robot = current_environment.get('robot', {})
     k = current_knowledge
+    pending = k.get('pending_orders', [])
+    in_progress = k.get('mission_in_progress', False)
     
-    pending_locs = [o['delivery_location'] for o in k.get('pending_orders', [])]
+    pending_locs = [o['delivery_location'] for o in pending]
     
-    seq_map = {}
-    for i, loc in enumerate(k.get('delivery_sequence', [])):
-        seq_map[f"{loc[0]},{loc[1]}"] = i + 1
+    sequence = k.get('delivery_sequence', [])
+    if sequence != seq_source:
+        seq_source = sequence
+        seq_map = build_seq_map(sequence)
     
     # Use original_last_delivery for path coloring (not current depleting sequence)
     last_del_loc = k.get('original_last_delivery')
     
-    countdown = "-"
-    pending = k.get('pending_orders', [])
-    if pending and not k.get('mission_in_progress'):
-        elapsed = time.time() - k.get('last_mission_start_time', time.time())
-        remaining = k.get('mission_timeout', 30) - elapsed
-        if remaining > 0:
-            countdown = f"{int(remaining // 60):02d}:{int(remaining % 60):02d}"
-        else:
-            countdown = "Starting..."
-    elif k.get('mission_in_progress'):
-        countdown = "In progress"
-    
-    times = k.get('delivery_times', [])
-    avg = sum(times) / len(times) if times else 0
-    
-    current_path = []
-    if k.get('mission_in_progress') and k.get('current_plan'):
-        current_path = k.get('current_plan', [])
-    
-    state = {
-        'grid': grid.get('grid', []),
-        'width': grid.get('width', 22),
-        'height': grid.get('height', 15),
-        'robot_position': robot.get('position', [1, 1]),
-        'base_location': grid.get('base_location', [1, 1]),
-        'delivery_locations': grid.get('delivery_locations', []),
-        'dynamic_obstacles': grid.get('dynamic_obstacles', []),
-        'pending_locations': pending_locs,
-        'delivery_sequence': seq_map,
-        'last_delivery_location': last_del_loc,
-        'current_path': current_path,
-        'current_path_index': k.get('current_plan_index', 0),
-        'loaded_orders': len(k.get('loaded_orders', [])),
-        'pending_count': len(pending),
-        'is_stuck': k.get('is_stuck', False),
-        'countdown': countdown,
-        'mission_in_progress': k.get('mission_in_progress', False),
-        'metrics': {
-            'total_deliveries': len(k.get('completed_orders', [])),
-            'total_distance': k.get('total_distance_traveled', 0),
-            'replans': k.get('number_of_replans', 0),
-            'avg_delivery_time': round(avg, 1)
-        }
-    }
+    # Whole seconds until auto-start (negative once due); the page formats it
+    countdown = None
+    if pending and not in_progress:
+        now = time.time()
+        elapsed = now - k.get('last_mission_start_time', now)
+        countdown = math.floor(k.get('mission_timeout', 30) - elapsed)
+    
+    # Running total over completed deliveries instead of the full list of times
+    completed = k.get('completed_count', 0)
+    avg = k.get('total_delivery_time', 0) / completed if completed else 0
+    
+    current_path = (k.get('current_plan') or []) if in_progress else []
+    
+    frame['robot_position'] = robot.get('position', [1, 1])
+    frame['dynamic_obstacles'] = grid.get('dynamic_obstacles', [])
+    frame['pending_locations'] = pending_locs
+    frame['delivery_sequence'] = seq_map
+    frame['last_delivery_location'] = last_del_loc
+    frame['current_path'] = current_path
+    frame['current_path_index'] = k.get('current_plan_index', 0)
+    frame['loaded_orders'] = len(k.get('loaded_orders', []))
+    frame['pending_count'] = len(pending)
+    frame['is_stuck'] = k.get('is_stuck', False)
+    frame['countdown'] = countdown
+    frame['mission_in_progress'] = in_progress
+    
+    metrics = frame['metrics']
+    metrics['total_deliveries'] = completed
+    metrics['total_distance'] = k.get('total_distance_traveled', 0)
+    metrics['replans'] = k.get('number_of_replans', 0)
+    metrics['avg_delivery_time'] = round(avg, 1)
+    return frame
+
+
+def broadcast_state():
+    global last_fields, static_dirty
     
-    socketio.emit('state_update', state)
+    state = build_state()
+    if state is None:
+        return
+    
+    # Clients already hold the last frame, so only top-level fields whose encoding changed are sent.
+    # Static fields change only with an environment snapshot and are not re-encoded per tick.
+    fields = {key: encode(state[key]) for key in DYNAMIC_FIELDS}
+    delta = {key: state[key] for key, value in fields.items() if last_fields.get(key) != value}
+    last_fields = fields
+    if static_dirty:
+        static_dirty = False
+        for key in STATIC_FIELDS:
+            delta[key] = state[key]
+    if delta:
+        socketio.emit('state_delta', delta)
 
 
 def connect_mqtt():
@@ -124,54 +290,88 @@ def connect_mqtt():
     
     mqtt_client = mqtt.Client(client_id=f"web-{os.getpid()}")
     mqtt_client.on_connect = on_mqtt_connect
+    mqtt_client.on_socket_open = on_socket_open
+    mqtt_client.on_connect_fail = on_mqtt_connect_fail
     mqtt_client.on_message = on_mqtt_message
     
-    for i in range(30):
-        try:
-            mqtt_client.connect(BROKER, PORT, 60)
-            mqtt_client.loop_start()
-            time.sleep(1)
-            return
-        except:
-            print(f"[Web] Waiting for MQTT... ({i+1})")
-            time.sleep(2)
-    raise Exception("MQTT connection failed")
+    # The network loop connects and retries with backoff; wait until subscribed
+    mqtt_client.reconnect_delay_set(min_delay=1, max_delay=30)
+    mqtt_client.connect_async(BROKER, PORT, 60)
+    mqtt_client.loop_start()
+    
+    deadline = time.monotonic() + MQTT_CONNECT_TIMEOUT
+    while not mqtt_ready:
+        if time.monotonic() > deadline:
+            raise Exception("MQTT connection failed")
+        time.sleep(0.05)
 
 
 def init_system():
-    mqtt_client.publish(TOPICS['system_init'], json.dumps({}))
-    time.sleep(0.5)
+    init_acks.clear()
+    init_done.clear()
+    mqtt_client.publish(SYSTEM_INIT, EMPTY_JSON)
+    
+    if not init_done.wait(INIT_TIMEOUT):
+        print("[Web] System init not acknowledged, starting anyway")
 
 
 def mape_loop():
-    global running, mqtt_client
+    global running, mqtt_client, state_dirty
     
     while True:
         if running and mqtt_client:
-            mqtt_client.publish(TOPICS['monitor_request'], json.dumps({}))
+            mqtt_client.publish(MONITOR_REQUEST, EMPTY_JSON)
+            # The countdown is the only field that moves without a state message
+            k = current_knowledge
+            if k and k.get('pending_orders') and not k.get('mission_in_progress'):
+                state_dirty = True
+        socketio.sleep(0.4)
+
+
+def emit_loop():
+    global state_dirty
+    
+    while True:
+        socketio.sleep(EMIT_INTERVAL)
+        # With no page open the state stays dirty; a connecting client gets a full frame anyway
+        if state_dirty and client_count:
+            state_dirty = False
             broadcast_state()
-        eventlet.sleep(0.4)
 
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return INDEX_HTML
 
 
 @app.route('/assets/<path:filename>')
 def assets(filename):
-    return send_from_directory('/app/assets', filename)
+    # Icons are static; let browsers cache them for a day (conditional requests still apply)
+    return send_from_directory('/app/assets', filename, max_age=86400)
 
 
 @socketio.on('connect')
 def handle_connect():
+    global last_fields, static_dirty, client_count
+    
     print('[Web] Client connected')
-    broadcast_state()
+    client_count += 1
+    
+    # last_fields may predate this page, so the next broadcast carries every field
+    last_fields = {}
+    static_dirty = True
+    
+    state = build_state()
+    if state is not None:
+        emit('state_update', state)
 
 
 @socketio.on('disconnect')
 def handle_disconnect():
+    global client_count
+    
     print('[Web] Client disconnected')
+    client_count -= 1
 
 
 @socketio.on('click')
@@ -183,17 +383,16 @@ def handle_click(data):
         return
     
     if current_environment:
-        grid = current_environment.get('grid', {})
-        if [row, col] in grid.get('delivery_locations', []):
+        if (row, col) in delivery_set:
             order_counter += 1
-            mqtt_client.publish(TOPICS['user_add_order'], json.dumps({
+            mqtt_client.publish(USER_ADD_ORDER, encode({
                 'order_id': f"ORD_{order_counter:03d}",
                 'delivery_location': [row, col],
                 'timestamp': time.time()
             }))
             print(f"[Web] Added order at [{row}, {col}]")
         else:
-            mqtt_client.publish(TOPICS['user_toggle_obstacle'], json.dumps({
+            mqtt_client.publish(USER_TOGGLE_OBSTACLE, encode({
                 'position': [row, col]
             }))
             print(f"[Web] Toggle obstacle at [{row}, {col}]")
@@ -206,7 +405,8 @@ def handle_reset():
     order_counter = 0
     current_knowledge = None
     current_environment = None
-    mqtt_client.publish(TOPICS['system_reset'], json.dumps({}))
+    last_applied.clear()
+    mqtt_client.publish(SYSTEM_RESET, EMPTY_JSON)
 
 
 if __name__ == '__main__':
@@ -216,11 +416,12 @@ if __name__ == '__main__':
     init_system()
     
     running = True
-    eventlet.spawn(mape_loop)
+    socketio.start_background_task(mape_loop)
+    socketio.start_background_task(emit_loop)
     
     print("=" * 50)
     print("Autonomous Delivery Robot - MAPE-K via MQTT")
     print("http://localhost:5000")
     print("=" * 50)
     
-    socketio.run(app, host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
+    socketio.run(app, host='0.0.0.0', port=5000, debug=False, allow_unsafe_werkzeug=True)
\ No newline at end of file